@@ -1,8 +1,10 @@
 import csv
+import io
 import logging
 import os
+import queue
+import threading
 import time
-from datetime import datetime
 
 from django.conf import settings
 from django.core.cache import caches
@@ -14,20 +16,61 @@ from kolibri.utils import conf
 from kolibri.utils.server import PROFILE_LOCK
 from kolibri.utils.system import pid_exists
 
-requests_profiling_file = os.path.join(
-    conf.KOLIBRI_HOME,
-    "performance",
-    "{}_requests_performance.csv".format(time.strftime("%Y%m%d_%H%M%S")),
-)
+logger = logging.getLogger(__name__)
+
+cp_logger = logging.getLogger("cherrypy.access")
 
 cache = caches[settings.CACHE_MIDDLEWARE_ALIAS]
+
+# One requests profiling row, matching csv.writer output when no field needs quoting
+_ROW_FMT = "{},{},{},{},{},{},{},{}\r\n"
+
+
+def get_debug_log_paths(url_path_prefix):
+    """
+    Exact paths and path prefixes of the busy polling endpoints, which
+    cherrypy_access_log_middleware logs as debug
+    """
+    url_path_prefix = "/" + url_path_prefix.lstrip("/")
+    return (
+        frozenset({url_path_prefix + "status/"}),
+        (url_path_prefix + "api/tasks/tasks/",),
+    )
+
+
+_DEBUG_LOG_PATHS, _DEBUG_LOG_PATH_PREFIXES = get_debug_log_paths(
+    conf.OPTIONS["Deployment"]["URL_PATH_PREFIX"]
+)
+
 try:
     import kolibri.utils.pskolibri as psutil
-
-    kolibri_process = psutil.Process()
 except NotImplementedError:
     # This middleware can't work on this OS
-    kolibri_process = None
+    psutil = None
+
+_kolibri_process = None
+_kolibri_process_pid = None
+
+
+def get_kolibri_process():
+    """
+    Cached psutil Process of the running Kolibri server.
+    It's recreated when the pid changes, as the server can fork worker processes
+    after this module has been imported.
+    """
+    global _kolibri_process, _kolibri_process_pid
+    pid = os.getpid()
+    if _kolibri_process_pid != pid:
+        _kolibri_process = psutil.Process(pid)
+        _kolibri_process_pid = pid
+    return _kolibri_process
+
+
+def _escape_quotes(value):
+    # Most values have no quotes, avoid copying them in that case
+    if '"' in value:
+        return value.replace('"', '\\"')
+    return value
 
 
 def cherrypy_access_log_middleware(get_response):
@@ -53,74 +96,159 @@ def cherrypy_access_log_middleware(get_response):
     """  # noqa ignore:E501
 
     def middleware(request):
-        # Code to be executed for each request before
-        # the view (and later middleware) are called.
-
-        cp_logger = logging.getLogger("cherrypy.access")
-
         response = get_response(request)
 
         # Code to be executed for each request/response after
         # the view is called.
 
+        # Silence busy polling API endpoints and PATCH requests:
+        # https://github.com/learningequality/kolibri/issues/6459
+        path = request.path_info
+        log_as_debug = (
+            request.method == "PATCH"
+            or path in _DEBUG_LOG_PATHS
+            or path.startswith(_DEBUG_LOG_PATH_PREFIXES)
+        )
+        level = logging.DEBUG if log_as_debug else logging.INFO
+        if not cp_logger.isEnabledFor(level):
+            return response
+
+        # Avoid consuming the content of streaming responses to get their size
+        body_size = response.get("Content-Length")
+        if body_size is None:
+            body_size = "-" if response.streaming else len(response.content)
+
+        meta = request.META
         log_message = '{h} {l} {u} "{r}" {s} {b} "{ref}" "{ua}"'.format(
-            h=request.META.get("REMOTE_ADDR", "unknown"),
+            h=meta.get("REMOTE_ADDR", "unknown"),
             l="-",  # noqa ignore:E741
             u="-",
-            r="{} {}".format(request.method, request.path_info.replace('"', "\\")),
+            r="{} {}".format(request.method, _escape_quotes(path)),
             s=response.status_code,
-            b=len(response.get("content", b"")),
-            ref=request.META.get("HTTP_REFERER", "").replace('"', "\\"),
-            ua=request.META.get("HTTP_USER_AGENT", "unknown").replace('"', "\\"),
-        )
-
-        # Silence busy polling API endpoints and PATCH requests:
-        # https://github.com/learningequality/kolibri/issues/6459
-        log_as_debug = (
-            "/api/tasks/tasks/" in request.path_info
-            or "/status/" == request.path_info
-            or request.method == "PATCH"
+            b=body_size,
+            ref=_escape_quotes(meta.get("HTTP_REFERER", "")),
+            ua=_escape_quotes(meta.get("HTTP_USER_AGENT", "unknown")),
         )
-        if log_as_debug:
-            cp_logger.debug(log_message)
-        else:
-            cp_logger.info(log_message)
+        cp_logger.log(level, log_message)
 
         return response
 
     return middleware
 
 
-class Metrics(object):
-    def __init__(self):
-        """
-        Save the initial values when the request comes in
-        This class only will be used when MetricsMiddleware is not disabled, thus the OS is supported.
-        External instances of this class must check if the OS is supported before creating new objects.
-        """
-        self.memory = self.get_used_memory()
-        self.load = self.get_load_average()
-        self.time = time.time()
+def get_process_usage():
+    """
+    Kolibri used memory (in bytes) and cpu load (in %).
+    Only used when MetricsMiddleware is not disabled, thus the OS is supported.
+    """
+    kolibri_process = get_kolibri_process()
+    return kolibri_process.memory_info().vms, kolibri_process.cpu_percent()
 
-    def get_used_memory(self):
-        return kolibri_process.memory_info().vms
 
-    def get_load_average(self):
-        return kolibri_process.cpu_percent()
+class RequestsProfilingWriter(object):
+    """
+    Writes the rows of one requests profiling session to its csv file from
+    a background thread, so the request threads never wait on disk.
+    Each session gets its own writer, queue and thread.
+    """
 
-    def get_stats(self):
+    # maximum number of rows written to the file per flush
+    flush_rows = 64
+    # maximum number of rows waiting for the writer thread
+    max_queued_rows = 4096
+
+    def __init__(self, path):
+        self._fh = open(path, mode="a", buffering=65536, newline="")
+        self._queue = queue.Queue(maxsize=self.max_queued_rows)
+        self._stop_event = threading.Event()
+        self._queue_full = False
+        # Rows are formatted into this buffer and written to the file in one go
+        self._csv_buf = io.StringIO()
+        self._csv_writer = csv.writer(
+            self._csv_buf, delimiter=",", quotechar='"', quoting=csv.QUOTE_MINIMAL
+        )
+        self._csv_writer.writerow(
+            (
+                "Date",
+                "Path",
+                "Duration",
+                "Memory before (Kb)",
+                "Memory after (Kb)",
+                "Load before (%)",
+                "Load after(%)",
+                "Longest time up to now",
+            )
+        )
+        self._write_rows([])
+        self._thread = threading.Thread(
+            target=self._run, name="requests-profiling-writer"
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write_row(self, row):
         """
-        Calcutes time spent in processing the request
-        and difference in memory and load consumed
-        by kolibri while processing the request
-        :returns: tuple of strings containing time consumed (in seconds),
-                  Kolibri used memory (in bytes) before and after executing the request,
-                  Kolibri cpu load (in %) before and after executing the request.
+        Queue one row to be written to the file.
+        The row is dropped if the writer thread can't keep up, profiling
+        must never block or break the request.
         """
-        memory = str(self.get_used_memory())
-        load = str(self.get_load_average())
-        time_delta = str(time.time() - self.time)
-        return (time_delta, str(self.memory), memory, str(self.load), load)
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            if not self._queue_full:
+                self._queue_full = True
+                logger.warning("Requests profiling queue is full, dropping rows")
+        else:
+            if self._queue_full:
+                self._queue_full = False
+
+    def stop(self):
+        """
+        Ask the writer thread to write the queued rows and close the file,
+        without waiting for it
+        """
+        self._stop_event.set()
+        try:
+            # Wake up the thread if it's waiting for rows
+            self._queue.put_nowait(None)
+        except queue.Full:
+            pass  # the thread is busy and will stop once the queue is empty
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+    def _write_rows(self, rows):
+        for row in rows:
+            # Only the path can contain characters that need quoting
+            path = row[1]
+            if "," in path or '"' in path or "\n" in path or "\r" in path:
+                self._csv_writer.writerow(row)
+            else:
+                self._csv_buf.write(_ROW_FMT.format(*row))
+        data = self._csv_buf.getvalue()
+        self._csv_buf.seek(0)
+        self._csv_buf.truncate()
+        self._fh.write(data)
+        self._fh.flush()
+
+    def _run(self):
+        while True:
+            rows = [self._queue.get()]
+            while len(rows) < self.flush_rows:
+                try:
+                    rows.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write_rows([row for row in rows if row is not None])
+            except Exception:
+                logger.exception("Error writing the requests profiling file")
+            if self._stop_event.is_set() and self._queue.empty():
+                break
+        try:
+            self._fh.close()
+        except Exception:
+            logger.exception("Error closing the requests profiling file")
 
 
 class MetricsMiddleware(MiddlewareMixin):
@@ -139,6 +267,21 @@ class MetricsMiddleware(MiddlewareMixin):
     slowest_request_time = 0
     disabled = True
     command_pid = 0
+    # guards enabling and disabling the middleware and its profiling writer
+    _profile_lock = threading.Lock()
+    _profile_writer = None
+    # seconds to wait between checks for the profile lock file
+    lock_check_interval = 1.0
+    _last_lock_check = 0.0
+    # responses to process, or seconds to wait, between checks that the
+    # profile command is running
+    liveness_check_requests = 100
+    liveness_check_interval = 1.0
+    _liveness_counter = 0
+    _last_liveness_check = 0.0
+    _liveness_lock = threading.Lock()
+    # (second, formatted date) of the last timestamp written
+    _ts_cache = (0, "")
 
     def __init__(self, get_response=None):
         super(MetricsMiddleware, self).__init__(get_response=get_response)
@@ -149,66 +292,96 @@ class MetricsMiddleware(MiddlewareMixin):
         """
         Store the start time, memory and load when the request comes in.
         """
-        if not self.disabled:
-            self.metrics = Metrics()
+        if MetricsMiddleware.disabled:
+            return
+        # Stored on the request as the middleware instance is shared by all threads
+        memory, load = get_process_usage()
+        request._kolibri_prof = (time.monotonic(), memory, load)
 
     def shutdown(self):
         """
         Disable this middleware and clean all the static variables
         """
-        MetricsMiddleware.disabled = True
-        MetricsMiddleware.command_pid = 0
-        delattr(self, "metrics")
+        with MetricsMiddleware._profile_lock:
+            if MetricsMiddleware.disabled:
+                return  # already shut down by another request
+            command_pid = MetricsMiddleware.command_pid
+            MetricsMiddleware.disabled = True
+            MetricsMiddleware.command_pid = 0
+            MetricsMiddleware._liveness_counter = 0
+            profile_writer = MetricsMiddleware._profile_writer
+            MetricsMiddleware._profile_writer = None
+        if profile_writer is not None:
+            # The writer thread writes the queued rows and closes the file
+            profile_writer.stop()
         if os.path.exists(PROFILE_LOCK):
             try:
-                os.remove(PROFILE_LOCK)
-            except OSError:
-                pass  # lock file was deleted by other process
+                with open(PROFILE_LOCK, "r") as f:
+                    lock_pid = int(f.readline())
+            except (IOError, TypeError, ValueError):
+                lock_pid = None
+            # Don't delete the lock of a profile command started after ours
+            if lock_pid is None or lock_pid == command_pid:
+                try:
+                    os.remove(PROFILE_LOCK)
+                except OSError:
+                    pass  # lock file was deleted by other process
+
+    def write_row(self, row):
+        profile_writer = MetricsMiddleware._profile_writer
+        if profile_writer is not None:
+            profile_writer.write_row(row)
+
+    @classmethod
+    def get_timestamp(cls):
+        """
+        Current local time formatted as `%Y/%m/%d %H:%M:%S.%f`, reusing
+        the date part formatted for previous requests in the same second
+        """
+        now = time.time()
+        sec = int(now)
+        cached_sec, prefix = cls._ts_cache
+        if sec != cached_sec:
+            prefix = time.strftime("%Y/%m/%d %H:%M:%S", time.localtime(sec))
+            cls._ts_cache = (sec, prefix)
+        return "{}.{:06d}".format(prefix, int((now - sec) * 1000000))
 
     def check_start_conditions(self):
         """
         Do the needed checks to enable the Middleware if possible
         """
-        if MetricsMiddleware.disabled and conf.OPTIONS["Server"]["PROFILE"]:
-            if os.path.exists(PROFILE_LOCK):
+        if not MetricsMiddleware.disabled or not conf.OPTIONS["Server"]["PROFILE"]:
+            return
+        # Don't stat the lock file more than once per lock_check_interval
+        now = time.monotonic()
+        if now - MetricsMiddleware._last_lock_check < self.lock_check_interval:
+            return
+        MetricsMiddleware._last_lock_check = now
+        if os.path.exists(PROFILE_LOCK):
+            try:
+                with open(PROFILE_LOCK, "r") as f:
+                    command_pid = int(f.readline())
+                    file_timestamp = f.readline()
+                if SUPPORTED_OS:
+                    with MetricsMiddleware._profile_lock:
+                        if not MetricsMiddleware.disabled:
+                            return  # enabled by another request meanwhile
+                        self.requests_profiling_file = os.path.join(
+                            conf.KOLIBRI_HOME,
+                            "performance",
+                            "{}_requests_performance.csv".format(file_timestamp),
+                        )
+                        MetricsMiddleware._profile_writer = RequestsProfilingWriter(
+                            self.requests_profiling_file
+                        )
+                        MetricsMiddleware.command_pid = command_pid
+                        MetricsMiddleware.disabled = False
+            except (IOError, TypeError, ValueError):
+                # Kolibri command PID file has been deleted or it's corrupted
                 try:
-                    with open(PROFILE_LOCK, "r") as f:
-                        MetricsMiddleware.command_pid = int(f.readline())
-                        file_timestamp = f.readline()
-                        if SUPPORTED_OS:
-                            MetricsMiddleware.disabled = False
-                            self.requests_profiling_file = os.path.join(
-                                conf.KOLIBRI_HOME,
-                                "performance",
-                                "{}_requests_performance.csv".format(file_timestamp),
-                            )
-                            with open(
-                                self.requests_profiling_file, mode="a"
-                            ) as profile_file:
-                                profile_writer = csv.writer(
-                                    profile_file,
-                                    delimiter=",",
-                                    quotechar='"',
-                                    quoting=csv.QUOTE_MINIMAL,
-                                )
-                                profile_writer.writerow(
-                                    (
-                                        "Date",
-                                        "Path",
-                                        "Duration",
-                                        "Memory before (Kb)",
-                                        "Memory after (Kb)",
-                                        "Load before (%)",
-                                        "Load after(%)",
-                                        "Longest time up to now",
-                                    )
-                                )
-                except (IOError, TypeError, ValueError):
-                    # Kolibri command PID file has been deleted or it's corrupted
-                    try:
-                        os.remove(PROFILE_LOCK)
-                    except OSError:
-                        pass  # lock file was deleted by other process
+                    os.remove(PROFILE_LOCK)
+                except OSError:
+                    pass  # lock file was deleted by other process
 
     def process_response(self, request, response):
         """
@@ -218,22 +391,23 @@ class MetricsMiddleware(MiddlewareMixin):
         cpu load before, cpu load after the request is finished, max
         Being `max` True or False to indicate if this is the slowest request since logging began.
         """
-        self.check_start_conditions()
-
-        if not MetricsMiddleware.disabled and hasattr(self, "metrics"):
+        if MetricsMiddleware.disabled:
+            # The profile command enables the middleware by creating its
+            # lock file, check_start_conditions looks for it periodically
+            self.check_start_conditions()
+            return response
+
+        start_values = getattr(request, "_kolibri_prof", None)
+        if start_values is not None:
+            start_time, memory_before, load_before = start_values
+            memory, load = get_process_usage()
+            duration = time.monotonic() - start_time
             path = request.get_full_path()
-            (
-                duration,
-                memory_before,
-                memory,
-                load_before,
-                load,
-            ) = self.metrics.get_stats()
             max_time = False
-            if float(duration) > MetricsMiddleware.slowest_request_time:
-                MetricsMiddleware.slowest_request_time = float(duration)
+            if duration > MetricsMiddleware.slowest_request_time:
+                MetricsMiddleware.slowest_request_time = duration
                 max_time = True
-            timestamp = datetime.now().strftime("%Y/%m/%d %H:%M:%S.%f")
+            timestamp = self.get_timestamp()
             collected_information = (
                 timestamp,
                 path,
@@ -244,16 +418,25 @@ class MetricsMiddleware(MiddlewareMixin):
                 load,
                 str(max_time),
             )
-            with open(self.requests_profiling_file, mode="a") as profile_file:
-                profile_writer = csv.writer(
-                    profile_file,
-                    delimiter=",",
-                    quotechar='"',
-                    quoting=csv.QUOTE_MINIMAL,
-                )
-                profile_writer.writerow(collected_information)
-            if not pid_exists(MetricsMiddleware.command_pid) or not os.path.exists(
-                PROFILE_LOCK
-            ):
-                self.shutdown()
+            self.write_row(collected_information)
+        # Checking the profile command is still alive costs a couple of
+        # syscalls, so only do it every liveness_check_requests responses
+        # or liveness_check_interval seconds, whichever comes first
+        MetricsMiddleware._liveness_counter += 1
+        now = time.monotonic()
+        if (
+            MetricsMiddleware._liveness_counter >= self.liveness_check_requests
+            or now - MetricsMiddleware._last_liveness_check
+            >= self.liveness_check_interval
+        ) and MetricsMiddleware._liveness_lock.acquire(False):
+            # Only one request runs the check, the others carry on
+            try:
+                MetricsMiddleware._liveness_counter = 0
+                MetricsMiddleware._last_liveness_check = now
+                if not pid_exists(MetricsMiddleware.command_pid) or not os.path.exists(
+                    PROFILE_LOCK
+                ):
+                    self.shutdown()
+            finally:
+                MetricsMiddleware._liveness_lock.release()
         return response
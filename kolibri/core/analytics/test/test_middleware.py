@@ -0,0 +1,243 @@
+import csv
+import io
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+from django.http import HttpResponse
+from django.http import StreamingHttpResponse
+from django.test import SimpleTestCase
+from django.test.client import RequestFactory
+from mock import patch
+
+from kolibri.core.analytics import middleware
+from kolibri.utils import conf
+from kolibri.utils.server import PROFILE_LOCK
+from kolibri.utils.tests.helpers import override_option
+
+
+def csv_output(rows):
+    output = io.StringIO()
+    writer = csv.writer(output, delimiter=",", quotechar='"', quoting=csv.QUOTE_MINIMAL)
+    for row in rows:
+        writer.writerow(row)
+    return output.getvalue()
+
+
+def profiling_row(path):
+    return (
+        "2020/02/19 00:01:29.440123",
+        path,
+        0.012345678901234567,
+        123457536,
+        123461632,
+        0.0,
+        12.5,
+        "True",
+    )
+
+
+class RequestsProfilingRowTestCase(SimpleTestCase):
+    def test_row_format_matches_csv_writer(self):
+        for path in ("/", "/api/content/contentnode/?page=2&kind=video"):
+            row = profiling_row(path)
+            self.assertEqual(middleware._ROW_FMT.format(*row), csv_output([row]))
+
+    def test_writer_output_matches_csv_writer(self):
+        rows = [
+            profiling_row("/api/content/contentnode/"),
+            profiling_row("/api/content/contentnode/?ids=a,b"),
+            profiling_row('/api/content/contentnode/?search="video"'),
+            profiling_row("/api/content/contentnode/?search=line\nbreak"),
+            profiling_row("/api/content/contentnode/?search=line\rbreak"),
+        ]
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, "requests_performance.csv")
+        writer = middleware.RequestsProfilingWriter(path)
+        for row in rows:
+            writer.write_row(row)
+        writer.stop()
+        writer.join(5)
+        with open(path, newline="") as f:
+            header = f.readline()
+            self.assertTrue(header.startswith("Date,Path,Duration,"))
+            self.assertEqual(f.read(), csv_output(rows))
+
+
+@override_option("Server", "PROFILE", True)
+class MetricsMiddlewareTestCase(SimpleTestCase):
+    def setUp(self):
+        self.performance_dir = os.path.join(conf.KOLIBRI_HOME, "performance")
+        if not os.path.exists(self.performance_dir):
+            os.mkdir(self.performance_dir)
+        self.middleware = middleware.MetricsMiddleware(lambda request: HttpResponse())
+        self.addCleanup(self.middleware.shutdown)
+
+    def start_profiling(self, file_timestamp):
+        with open(PROFILE_LOCK, "w") as f:
+            f.write("{}\n{}".format(os.getpid(), file_timestamp))
+        middleware.MetricsMiddleware._last_lock_check = 0.0
+        self.profile_request("/")
+        self.assertFalse(middleware.MetricsMiddleware.disabled)
+        path = os.path.join(
+            self.performance_dir, "{}_requests_performance.csv".format(file_timestamp)
+        )
+        self.addCleanup(os.remove, path)
+        return path
+
+    def stop_profiling(self):
+        profile_writer = middleware.MetricsMiddleware._profile_writer
+        self.middleware.shutdown()
+        profile_writer.join(5)
+        self.assertTrue(middleware.MetricsMiddleware.disabled)
+        self.assertFalse(os.path.exists(PROFILE_LOCK))
+
+    def profile_request(self, path):
+        request = RequestFactory().get(path)
+        self.middleware.process_request(request)
+        self.middleware.process_response(request, HttpResponse())
+
+    def read_paths(self, path):
+        with open(path, newline="") as f:
+            return [row[1] for row in list(csv.reader(f))[1:]]
+
+    def test_rows_written(self):
+        path = self.start_profiling("test_rows_written")
+        self.profile_request("/api/content/contentnode/")
+        self.profile_request("/api/content/contentnode/?ids=a,b")
+        self.stop_profiling()
+        self.assertEqual(
+            self.read_paths(path),
+            ["/api/content/contentnode/", "/api/content/contentnode/?ids=a,b"],
+        )
+
+    def test_restart_profiling(self):
+        first_path = self.start_profiling("test_restart_profiling_1")
+        self.profile_request("/first/")
+        profile_writer = middleware.MetricsMiddleware._profile_writer
+        # Overlapping shutdowns must not affect the next session
+        threads = [threading.Thread(target=self.middleware.shutdown) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        profile_writer.join(5)
+        second_path = self.start_profiling("test_restart_profiling_2")
+        self.profile_request("/second/")
+        self.stop_profiling()
+        self.assertEqual(self.read_paths(first_path), ["/first/"])
+        self.assertEqual(self.read_paths(second_path), ["/second/"])
+
+    def test_shutdown_when_profile_command_exits(self):
+        path = self.start_profiling("test_shutdown_when_profile_command_exits")
+        profile_writer = middleware.MetricsMiddleware._profile_writer
+        middleware.MetricsMiddleware._last_liveness_check = 0.0
+        with patch.object(middleware, "pid_exists", return_value=False):
+            self.profile_request("/last/")
+        profile_writer.join(5)
+        self.assertTrue(middleware.MetricsMiddleware.disabled)
+        self.assertEqual(self.read_paths(path), ["/last/"])
+
+
+class AccessLogMiddlewareTestMixin(object):
+    def get_access_log(self, request, response=None):
+        if response is None:
+            response = HttpResponse()
+        access_log_middleware = middleware.cherrypy_access_log_middleware(
+            lambda request: response
+        )
+        with self.assertLogs("cherrypy.access", level="DEBUG") as logs:
+            access_log_middleware(request)
+        self.assertEqual(len(logs.records), 1)
+        return logs.records[0]
+
+    def assertLogLevel(self, path, level, method="get"):
+        request = getattr(RequestFactory(), method)(path)
+        self.assertEqual(self.get_access_log(request).levelno, level)
+
+
+class AccessLogMiddlewareTestCase(AccessLogMiddlewareTestMixin, SimpleTestCase):
+    def test_polling_endpoints_logged_as_debug(self):
+        self.assertLogLevel("/status/", logging.DEBUG)
+        self.assertLogLevel("/api/tasks/tasks/", logging.DEBUG)
+        self.assertLogLevel("/api/tasks/tasks/a1b2c3/", logging.DEBUG)
+
+    def test_patch_logged_as_debug(self):
+        self.assertLogLevel("/api/auth/facilityuser/1/", logging.DEBUG, "patch")
+
+    def test_other_requests_logged_as_info(self):
+        self.assertLogLevel("/api/content/contentnode/", logging.INFO)
+        self.assertLogLevel("/status/extra/", logging.INFO)
+        self.assertLogLevel("/en/api/tasks/tasks/", logging.INFO)
+
+    def test_quotes_escaped(self):
+        request = RequestFactory().get(
+            "/api/content/contentnode/",
+            HTTP_REFERER='http://localhost/?search="video"',
+            HTTP_USER_AGENT='Agent "quoted"',
+            REMOTE_ADDR="127.0.0.1",
+        )
+        self.assertEqual(
+            self.get_access_log(request).getMessage(),
+            '127.0.0.1 - - "GET /api/content/contentnode/" 200 0 '
+            '"http://localhost/?search=\\"video\\"" "Agent \\"quoted\\""',
+        )
+
+    def assertBodySize(self, response, size):
+        request = RequestFactory().get("/content/storage/file.mp4")
+        self.assertIn(
+            '"GET /content/storage/file.mp4" 200 {} '.format(size),
+            self.get_access_log(request, response).getMessage(),
+        )
+
+    def test_body_size(self):
+        self.assertBodySize(HttpResponse(b"video data"), 10)
+
+    def test_body_size_from_content_length(self):
+        response = HttpResponse(b"video data")
+        response["Content-Length"] = "1048576"
+        self.assertBodySize(response, 1048576)
+
+    def test_body_size_streaming_response(self):
+        response = StreamingHttpResponse(iter([b"video ", b"data"]))
+        self.assertBodySize(response, "-")
+        # The content is still there to be sent
+        self.assertEqual(b"".join(response.streaming_content), b"video data")
+
+
+class AccessLogMiddlewareURLPrefixTestCase(
+    AccessLogMiddlewareTestMixin, SimpleTestCase
+):
+    def setUp(self):
+        debug_log_paths, debug_log_path_prefixes = middleware.get_debug_log_paths(
+            "kolibri/"
+        )
+        for name, value in (
+            ("_DEBUG_LOG_PATHS", debug_log_paths),
+            ("_DEBUG_LOG_PATH_PREFIXES", debug_log_path_prefixes),
+        ):
+            patcher = patch.object(middleware, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_debug_log_paths(self):
+        self.assertEqual(
+            middleware.get_debug_log_paths("/"),
+            (frozenset({"/status/"}), ("/api/tasks/tasks/",)),
+        )
+        self.assertEqual(
+            middleware.get_debug_log_paths("kolibri/"),
+            (frozenset({"/kolibri/status/"}), ("/kolibri/api/tasks/tasks/",)),
+        )
+
+    def test_polling_endpoints_logged_as_debug(self):
+        self.assertLogLevel("/kolibri/status/", logging.DEBUG)
+        self.assertLogLevel("/kolibri/api/tasks/tasks/", logging.DEBUG)
+        self.assertLogLevel("/kolibri/api/tasks/tasks/a1b2c3/", logging.DEBUG)
+
+    def test_other_requests_logged_as_info(self):
+        self.assertLogLevel("/kolibri/api/content/contentnode/", logging.INFO)
+        self.assertLogLevel("/status/", logging.INFO)